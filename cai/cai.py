@@ -1,12 +1,14 @@
 from __future__ import annotations
 
+import asyncio
+import re
 import zipfile
 from asyncio import Lock
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timezone
 from io import BytesIO
-from textwrap import indent
-from typing import TYPE_CHECKING, Type
+from operator import attrgetter
+from typing import TYPE_CHECKING, Any, Type
 from urllib.parse import urljoin
 from uuid import uuid4
 
@@ -14,19 +16,29 @@ from characterai import PyAsyncCAI
 from maubot import MessageEvent, Plugin
 from maubot.handlers import command, event
 from mautrix.types import (
+    ContentURI,
     EventType,
     Format,
+    Membership,
     MessageType,
     RelationType,
+    StateEvent,
     TextMessageEventContent,
     UserID,
 )
 from mautrix.util import markdown
 from mautrix.util.async_db import Connection, UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
+from websockets.exceptions import ConnectionClosed
 
 from . import utils
-from .caimessage import CAIMessage, ExportFile, history_to_json, history_to_txt
+from .caimessage import (
+    CAIMessage,
+    ExportFile,
+    history_to_cbor,
+    history_to_json,
+    history_to_txt,
+)
 
 if TYPE_CHECKING:
     from mautrix.client import Client
@@ -34,19 +46,74 @@ if TYPE_CHECKING:
 
 BASE_AVATAR_URL = "https://characterai.io/i/400/static/avatars/"
 
+NO_CHAT_MESSAGE = (
+    "This room doesn't have an AI chat yet. Create one with `!cai new_chat`"
+)
+NO_CHARACTER_MESSAGE = "No character id was provided and no default character is set."
+NOTHING_TO_SYNC_MESSAGE = (
+    "Both `use_char_name` and `use_char_avatar` are disabled, nothing to do."
+)
+# The fixed messages never change, so we only render them once
+STATIC_MESSAGES_HTML = {
+    message: markdown.render(message)
+    for message in (NO_CHAT_MESSAGE, NO_CHARACTER_MESSAGE, NOTHING_TO_SYNC_MESSAGE)
+}
+
+# Anything that isn't alphanumeric or an underscore, removed from export file names
+UNSAFE_FILENAME_CHARS_RE = re.compile(r"\W")
+
 
 @asynccontextmanager
 async def client_typing(
-    client: Client, event: MessageEvent, *, timeout: int = 60_000
+    client: Client,
+    event: MessageEvent,
+    *,
+    timeout: int = 30_000,
+    refresh_interval: float = 25,
+    mark_read: bool = False,
 ) -> None:
-    """Context manager to set typing status for the duration of the block."""
+    """
+    Context manager to set typing status for the duration of the block.
+    The typing status is refreshed every refresh_interval seconds, so it
+    doesn't expire if the block takes longer than the timeout.
+    If mark_read is True, also marks the event as read at the same time.
+    """
+
+    async def keep_typing() -> None:
+        while True:
+            await client.set_typing(event.room_id, timeout=timeout)
+            await asyncio.sleep(refresh_interval)
+
+    typing_task = asyncio.create_task(keep_typing())
     try:
-        await client.set_typing(event.room_id, timeout=timeout)
+        if mark_read:
+            await event.mark_read()
         yield
     finally:
+        typing_task.cancel()
+        # The typing status is only cosmetic, so we ignore its errors
+        await asyncio.gather(typing_task, return_exceptions=True)
         await client.set_typing(event.room_id, timeout=0)
 
 
+class _SendTracker:
+    """
+    Wraps the CAI websocket, to know if a request was sent before the connection
+    closed. Everything else is forwarded to the websocket.
+    """
+
+    def __init__(self, ws: Any) -> None:
+        self.ws = ws
+        self.sent = False
+
+    async def send(self, message: str) -> None:
+        await self.ws.send(message)
+        self.sent = True
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.ws, name)
+
+
 upgrade_table = UpgradeTable()
 
 
@@ -72,6 +139,7 @@ class Config(BaseProxyConfig):
         helper.copy("reply_is_trigger")
         helper.copy("always_reply_in_dm")
         helper.copy("reply_to_message")
+        helper.copy("mark_read_all")
         helper.copy("show_prompt_in_reply")
         helper.copy("use_char_name")
         helper.copy("use_char_avatar")
@@ -79,51 +147,137 @@ class Config(BaseProxyConfig):
         helper.copy("group_mode_template")
         helper.copy("export_txt")
         helper.copy("export_json")
+        helper.copy("export_cbor")
+        helper.copy("export_gzip")
+        helper.copy("response_cache_enabled")
 
 
 class CAIBot(Plugin):
     async def start(self) -> None:
         self.config.load_and_update()
+        self._cache_config()
+
+        # (character_id, chat_id, normalized prompt) -> AI reply
+        self._response_cache: utils.TTLCache[
+            tuple[str, str, str], str
+        ] = utils.TTLCache(maxsize=1024, ttl=3600)
 
-        self._lock = Lock()
+        # room_id -> joined members
+        # Seeded on the first lookup, then kept up to date with membership events.
+        # A set, so membership events that are received twice don't change it.
+        self._room_members: dict[str, set[UserID]] = {}
+
+        # room_id -> (character_id, chat_id)
+        # Rooms only change chat on !cai new, so we keep them all in memory
+        async with self.database.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT matrix_room_id, cai_character_id, cai_chat_id FROM rooms"
+            )
+        self._room_chats: dict[str, tuple[str, str]] = {
+            row["matrix_room_id"]: (row["cai_character_id"], row["cai_chat_id"])
+            for row in rows
+        }
+
+        # character_id -> (name, avatar_uri)
+        self._char_info_cache: dict[str, tuple[str, str]] = {}
+        # avatar_uri -> mxc url of the uploaded avatar
+        # Keyed by uri, so a new avatar for a character is uploaded again
+        self._avatar_mxc_cache: dict[str, ContentURI] = {}
 
         # Setup the CAI api
         self.cai_client = PyAsyncCAI(self.config["token"])
         user_info = await self.cai_client.user.info()
         self.user_id = str(user_info["user"]["user"]["id"])
 
+        # A single websocket connection is shared by the CAI chat calls,
+        # to avoid doing a handshake for every message.
+        # characterai doesn't match replies to requests, so the calls on it are
+        # serialized, even across rooms
+        self._chat2_lock = Lock()
+        self._chat2_ctx = None
+        self.chat2 = None
+        await self._connect_chat2()
+
+    async def stop(self) -> None:
+        await self._close_chat2()
+
+    async def _connect_chat2(self) -> None:
+        """Opens the shared websocket connection to CAI."""
+        self._chat2_ctx = self.cai_client.connect()
+        self.chat2 = await self._chat2_ctx.__aenter__()
+        self.chat2.ws = _SendTracker(self.chat2.ws)
+
+    async def _close_chat2(self) -> None:
+        """Closes the shared websocket connection to CAI, if it's open."""
+        ctx, self._chat2_ctx, self.chat2 = self._chat2_ctx, None, None
+        if ctx is not None:
+            # The connection may already be dead, which is why we're closing it
+            with suppress(ConnectionClosed):
+                await ctx.__aexit__(None, None, None)
+
+    async def _chat2_call(self, method: str, *args: Any) -> Any:
+        """
+        Calls a method on the shared websocket connection.
+        If the connection was closed, reconnects first. If it gets closed before
+        the request was sent, reconnects and tries again once.
+        """
+        # The websocket can only handle one request at a time
+        async with self._chat2_lock:
+            for attempt in range(2):
+                if attempt or self.chat2 is None or self.chat2.ws.closed:
+                    if attempt:
+                        self.log.warning("CAI connection was closed, reconnecting")
+                    await self._close_chat2()
+                    await self._connect_chat2()
+
+                self.chat2.ws.sent = False
+                try:
+                    return await getattr(self.chat2, method)(*args)
+                except BaseException as e:
+                    # characterai reads whatever frame comes next as the reply, so if
+                    # the request went out, its reply could be read by the next call.
+                    # It's also not safe to retry, the server may already handle it.
+                    if self.chat2.ws.sent:
+                        await self._close_chat2()
+                        raise
+                    if attempt or not isinstance(e, ConnectionClosed):
+                        raise
+
+    async def _cai_rest_call(self, method: str, *args: Any) -> Any:
+        """
+        Calls one of the CAI REST methods in a thread.
+        characterai makes its HTTP requests with the synchronous tls_client,
+        even in its coroutines, so they would block the event loop.
+        """
+        # The coroutine never awaits anything, but it still needs a loop to run on
+        coro = getattr(self.cai_client.chat2, method)(*args)
+        return await asyncio.to_thread(asyncio.run, coro)
+
     async def _insert_room_chat(
         self, *, room_id: str, character_id: str, chat_id: str
     ) -> None:
         """Associates a room with a CAI chat in the database."""
         async with self.database.acquire() as conn:
             await conn.execute(
-                "REPLACE INTO rooms (matrix_room_id, cai_character_id, cai_chat_id) VALUES (?, ?, ?)",
+                """INSERT INTO rooms (matrix_room_id, cai_character_id, cai_chat_id)
+                VALUES (?, ?, ?)
+                ON CONFLICT (matrix_room_id) DO UPDATE SET
+                    cai_character_id = excluded.cai_character_id,
+                    cai_chat_id = excluded.cai_chat_id""",
                 room_id,
                 character_id,
                 chat_id,
             )
+        self._room_chats[room_id] = (character_id, chat_id)
 
-    async def _get_chat_by_room(self, room_id: str) -> tuple[str, str] | None:
+    def _get_chat_by_room(self, room_id: str) -> tuple[str, str] | None:
         """Gets the character_id and chat_id for a room, if it exists in the db."""
-        async with self.database.acquire() as conn:
-            result = await conn.fetchrow(
-                "SELECT cai_chat_id, cai_character_id FROM rooms WHERE matrix_room_id = ?",
-                room_id,
-            )
-            return (
-                (result["cai_character_id"], result["cai_chat_id"])
-                if result is not None
-                else None
-            )
+        return self._room_chats.get(room_id)
 
-    async def _handle_group_mode(self, event: MessageEvent, text: str) -> str:
+    def _handle_group_mode(self, event: MessageEvent, text: str, *, is_dm: bool) -> str:
         """Applies the group mode template if needed"""
-        if self.config["group_mode"] == True or (
-            self.config["group_mode"] is None
-            and not await self._is_room_dm(event.room_id)
-        ):
-            text = self.config["group_mode_template"].format(
+        if self._group_mode == True or (self._group_mode is None and not is_dm):
+            text = self._group_mode_template.format(
                 username=self.client.parse_user_id(event.sender)[0],
                 text=text,
             )
@@ -132,60 +286,86 @@ class CAIBot(Plugin):
     async def send_message_to_ai(
         self, text: str, *, character_id: str, chat_id: str
     ) -> str:
-        """Sends a message to the AI, and returns the response."""
+        """
+        Sends a message to the AI, and returns the response.
+        If the response cache is enabled, a prompt that was already sent
+        to this chat recently gets the same reply, without asking the AI.
+        """
+        cache_key = (character_id, chat_id, text.strip().casefold())
+        if self._response_cache_enabled:
+            cached_reply = self._response_cache.get(cache_key)
+            if cached_reply is not None:
+                return cached_reply
+
+        data = await self._chat2_call(
+            "send_message",
+            character_id,
+            chat_id,
+            text,
+            {"author_id": self.user_id},
+        )
+        reply = data["turn"]["candidates"][0]["raw_content"]
 
-        async with self._lock:
-            async with self.cai_client.connect() as chat2:
-                data = await chat2.send_message(
-                    character_id,
-                    chat_id,
-                    text,
-                    {"author_id": self.user_id},
-                )
-            return data["turn"]["candidates"][0]["raw_content"]
+        if self._response_cache_enabled:
+            self._response_cache.set(cache_key, reply)
+        return reply
 
     async def create_ai_chat(self, character_id: str) -> tuple[str, str]:
         """Returns the chat_id and the first message from the AI."""
-        print("Creating new chat", {"c": character_id, "u": self.user_id})
-        async with self._lock:
-            async with self.cai_client.connect() as chat2:
-                char_chat = await chat2.new_chat(
-                    character_id,
-                    str(uuid4()),  # Why is this client side???
-                    self.user_id,
-                )
-            return (
-                char_chat[0]["chat"]["chat_id"],
-                char_chat[1]["turn"]["candidates"][0]["raw_content"],
-            )
+        self.log.debug(
+            "Creating new chat for character %s as user %s", character_id, self.user_id
+        )
+        char_chat = await self._chat2_call(
+            "new_chat",
+            character_id,
+            str(uuid4()),  # Why is this client side???
+            self.user_id,
+        )
+        return (
+            char_chat[0]["chat"]["chat_id"],
+            char_chat[1]["turn"]["candidates"][0]["raw_content"],
+        )
 
     async def get_chat_history(self, chat_id: str) -> list[CAIMessage]:
         """Returns all messages in a chat, from oldest to newest."""
-        async with self._lock:
-            async with self.cai_client.connect() as chat2:
-                data = await chat2.get_history(chat_id)
-            return sorted(
-                [CAIMessage.from_dict(msg) for msg in data["turns"]],
-                key=lambda m: m.create_time,
-            )
-
-    async def get_char_info(self, character_id: str) -> tuple[str, str]:
-        """Returns a tuple with the character's name and avatar url."""
+        # This is a plain HTTP request, it doesn't need the websocket
+        data = await self._cai_rest_call("get_history", chat_id)
+        history = [CAIMessage.from_dict(msg) for msg in data["turns"]]
+        # Timsort is already linear on sorted input, no need to check for it
+        history.sort(key=attrgetter("create_time"))
+        return history
+
+    async def get_char_info(
+        self, character_id: str, *, use_cache: bool = True
+    ) -> tuple[str, str]:
+        """
+        Returns a tuple with the character's name and avatar url.
+        The info is cached, unless use_cache is False.
+        """
+        if use_cache and character_id in self._char_info_cache:
+            return self._char_info_cache[character_id]
 
         # Get the character's info
         # We can't use character.info, as it doesn't work for private characters
         # info = await self.cai_client.character.info(character_id)
 
         # We use the chat info instead, but it requires a chat to exist already
-        async with self._lock:
-            async with self.cai_client.connect() as chat2:
-                chats_info = await chat2.get_chat(character_id)
+        # This is a plain HTTP request, it doesn't need the websocket
+        chats_info = await self._cai_rest_call("get_chat", character_id)
         info = chats_info["chats"][0]
 
-        return (info["character_name"], info["character_avatar_uri"])
+        char_info = (info["character_name"], info["character_avatar_uri"])
+        self._char_info_cache[character_id] = char_info
+        return char_info
 
     async def set_display_to_char_info(
-        self, room_id: str, character_id: str, *, copy_name: bool, copy_avatar: bool
+        self,
+        room_id: str,
+        character_id: str,
+        *,
+        copy_name: bool,
+        copy_avatar: bool,
+        use_cache: bool = True,
     ) -> None:
         """
         Sets the bot's nickname and room pfp to the CAI character's
@@ -195,21 +375,36 @@ class CAIBot(Plugin):
         if not copy_name and not copy_avatar:
             return
 
-        character_name, character_avatar_uri = await self.get_char_info(character_id)
+        character_name, character_avatar_uri = await self.get_char_info(
+            character_id, use_cache=use_cache
+        )
 
         content = {"membership": "join"}
         if copy_name:
             content["displayname"] = character_name
         if copy_avatar:
-            # download the avatar
-            avatar_url = urljoin(BASE_AVATAR_URL, character_avatar_uri)
-            async with self.http.get(avatar_url) as resp:
-                resp.raise_for_status()
-                avatar_content = await resp.read()
-                avarat_mimetype = resp.content_type
-            avatar_mxc = await self.client.upload_media(
-                avatar_content, mime_type=avarat_mimetype
-            )
+            # Reuse the avatar if we already uploaded it
+            avatar_mxc = self._avatar_mxc_cache.get(character_avatar_uri)
+            if avatar_mxc is None:
+                avatar_url = urljoin(BASE_AVATAR_URL, character_avatar_uri)
+                async with self.http.get(avatar_url) as resp:
+                    resp.raise_for_status()
+                    # The homeserver needs the upload's length up front. It's only
+                    # known if the response isn't chunked or transparently decompressed
+                    if (
+                        resp.content_length is not None
+                        and "Content-Encoding" not in resp.headers
+                    ):
+                        # Stream the avatar to the homeserver as it's downloaded
+                        data = resp.content.iter_chunked(64 * 1024)
+                        size = resp.content_length
+                    else:
+                        data = await resp.read()
+                        size = len(data)
+                    avatar_mxc = await self.client.upload_media(
+                        data, mime_type=resp.content_type, size=size
+                    )
+                self._avatar_mxc_cache[character_avatar_uri] = avatar_mxc
             content["avatar_url"] = avatar_mxc
 
         await self.client.send_state_event(
@@ -224,52 +419,59 @@ class CAIBot(Plugin):
         Returns True if the room is a DM, else False.
         A room is considered a DM it has 2 members
         """
-        return len(await self.client.get_joined_members(room_id)) == 2
+        members = self._room_members.get(room_id)
+        if members is None:
+            members = set(await self.client.get_joined_members(room_id))
+            self._room_members[room_id] = members
+        return len(members) == 2
 
     def is_user_allowed(self, user_id: UserID) -> bool:
         """True if the user is allowed to use the bot, else False."""
-
-        allowed_users = set(self.config["allowed_users"])
-
         # If the whitelist is empty, allow everyone
-        if not allowed_users:
-            return True
-
-        return user_id in allowed_users
+        return not self._allowed_users or user_id in self._allowed_users
 
-    async def is_bot_triggered(self, event: MessageEvent) -> bool:
-        """True if we should respond to this message, else False."""
-
-        if (
+    def is_message_ignored(self, event: MessageEvent) -> bool:
+        """
+        True if we should never respond to this message, else False.
+        Only does cheap checks, without any request.
+        """
+        content = event.content
+        # mautrix enums are singletons, so we can compare them by identity
+        return (
             event.sender == self.client.mxid  # Ignore our own messages
-            or event.content.relates_to["rel_type"]
-            == RelationType.REPLACE  # Ignore message edits
-            or event.content["msgtype"]
-            != MessageType.TEXT  # Ignore non-text messages (like images)
+            # Ignore non-text messages (like images)
+            or content.msgtype is not MessageType.TEXT
+            # Ignore message edits (relates_to is empty if there's no relation)
+            or content.relates_to.rel_type is RelationType.REPLACE
+            # Ignore command (prefix is always ! it seems)
+            or content.body.startswith("!")
             or not self.is_user_allowed(event.sender)  # Ignore non-whitelisted users
-            or event.content.body.startswith(
-                "!"
-            )  # Ignore command (prefix is always ! it seems)
-        ):
-            return False
+        )
 
-        if self.config["always_reply_in_dm"] and await self._is_room_dm(event.room_id):
+    async def is_bot_triggered(self, event: MessageEvent, *, is_dm: bool) -> bool:
+        """
+        True if we should respond to this message, else False.
+        Only call this for messages that is_message_ignored didn't reject.
+        """
+        if self._always_reply_in_dm and is_dm:
             return True
 
-        # Always returns True if the trigger is empty
-        if self.trigger in event.content.body.casefold():
+        # An empty trigger matches every message
+        if not self._trigger:
             return True
-
-        reply_to = event.content.get_reply_to()
-        if reply_to:
-            reply_to = await self.client.get_event(event.room_id, reply_to)
-        if (
-            self.config["reply_is_trigger"]
-            and reply_to
-            and reply_to.sender == self.client.mxid
-        ):
+        if self._trigger_re is not None:
+            if self._trigger_re.search(event.content.body):
+                return True
+        elif self._trigger in event.content.body.casefold():
             return True
 
+        # Only fetch the replied-to event if it could trigger us
+        if self._reply_is_trigger:
+            reply_to = event.content.get_reply_to()
+            if reply_to:
+                reply_to = await self.client.get_event(event.room_id, reply_to)
+                return reply_to.sender == self.client.mxid
+
         return False
 
     async def _reply(self, *, event: MessageEvent, body: str):
@@ -280,21 +482,51 @@ class CAIBot(Plugin):
             formatted_body=markdown.render(body),
             msgtype=MessageType.NOTICE,  # Looks distinct from normal messages
         )
-        return await event.respond(content, reply=self.config["reply_to_message"])
+        return await event.respond(content, reply=self._reply_to_message)
+
+    async def _reply_static(
+        self, *, event: MessageEvent, body: str, reply: bool = False
+    ):
+        """
+        Responds to a MessageEvent with one of the fixed messages,
+        using its prerendered HTML.
+        """
+        content = TextMessageEventContent(
+            format=Format.HTML,
+            body=body,
+            formatted_body=STATIC_MESSAGES_HTML[body],
+            msgtype=MessageType.NOTICE,
+        )
+        return await event.respond(content, reply=reply)
 
     async def _handle_exports(self, room_id: str):
-        if not (self.config["export_txt"] or self.config["export_json"]):
+        if not (
+            self.config["export_txt"]
+            or self.config["export_json"]
+            or self.config["export_cbor"]
+        ):
             # TODO: Add logging that we skipped the export
             return
 
-        character_id, chat_id = await self._get_chat_by_room(room_id)
-        history = await self.get_chat_history(chat_id)
-        character_name, _ = await self.get_char_info(character_id)
-        safe_character_name = "".join(
-            c for c in character_name.replace(" ", "_") if c.isalnum() or c == "_"
+        character_id, chat_id = self._get_chat_by_room(room_id)
+        # Both are blocking requests run in threads, so they can overlap
+        history, (character_name, _) = await asyncio.gather(
+            self.get_chat_history(chat_id),
+            self.get_char_info(character_id),
+        )
+        safe_character_name = UNSAFE_FILENAME_CHARS_RE.sub(
+            "", character_name.replace(" ", "_")
         )
         export_time_str = utils.pretty_utc_str(datetime.now(tz=timezone.utc))
 
+        # Multiple files get zipped, which already compresses them
+        compress = self.config["export_gzip"] and (
+            self.config["export_txt"]
+            + self.config["export_json"]
+            + self.config["export_cbor"]
+            == 1
+        )
+
         files: list[ExportFile] = []
         if self.config["export_txt"]:
             text_file = history_to_txt(
@@ -302,6 +534,7 @@ class CAIBot(Plugin):
                 character_name=character_name,
                 character_id=character_id,
                 chat_id=chat_id,
+                compress=compress,
             )
             files.append(text_file)
 
@@ -311,9 +544,22 @@ class CAIBot(Plugin):
                 character_name=character_name,
                 character_id=character_id,
                 chat_id=chat_id,
+                compress=compress,
             )
             files.append(json_file)
 
+        if self.config["export_cbor"]:
+            try:
+                cbor_file = history_to_cbor(
+                    history,
+                    character_name=character_name,
+                    character_id=character_id,
+                    chat_id=chat_id,
+                )
+                files.append(cbor_file)
+            except ImportError:
+                self.log.warning("export_cbor is enabled, but cbor2 isn't installed")
+
         # No output format were enabled, just do nothing
         if not files:
             return
@@ -321,14 +567,19 @@ class CAIBot(Plugin):
         # More than one file, zip them together
         if 1 < len(files):
             zip_file = BytesIO()
-            with zipfile.ZipFile(zip_file, mode="w") as zf:
+            # Chat logs compress very well, and the lowest level is plenty
+            with zipfile.ZipFile(
+                zip_file,
+                mode="w",
+                compression=zipfile.ZIP_DEFLATED,
+                compresslevel=1,
+            ) as zf:
                 for file in files:
                     zf.writestr(
                         f"cai-{safe_character_name}-{export_time_str}.{file.file_extension}",
                         file.data,
                     )
-            zip_file.seek(0)
-            file = ExportFile(".zip", "application/zip", zip_file.read())
+            file = ExportFile(".zip", "application/zip", zip_file.getvalue())
         # Only one file, just send it directly
         else:
             file = files[0]
@@ -360,48 +611,47 @@ class CAIBot(Plugin):
             if self.config["default_character_id"]:
                 character_id = self.config["default_character_id"]
             else:
-                await event.respond(
-                    "No character id was provided and no default character is set."
-                )
+                await self._reply_static(event=event, body=NO_CHARACTER_MESSAGE)
                 return
 
         async with client_typing(self.client, event):
             # If a chat already exists
-            if await self._get_chat_by_room(event.room_id) is not None:
+            if self._get_chat_by_room(event.room_id) is not None:
                 await self._handle_exports(room_id=event.room_id)
 
             chat_id, ai_reply = await self.create_ai_chat(character_id)
-            await self._insert_room_chat(
-                room_id=event.room_id, character_id=character_id, chat_id=chat_id
-            )
 
-            await self.set_display_to_char_info(
-                room_id=event.room_id,
-                character_id=character_id,
-                copy_name=self.config["use_char_name"],
-                copy_avatar=self.config["use_char_avatar"],
+            # Saving the chat and updating the display don't depend on each other
+            await asyncio.gather(
+                self._insert_room_chat(
+                    room_id=event.room_id, character_id=character_id, chat_id=chat_id
+                ),
+                self.set_display_to_char_info(
+                    room_id=event.room_id,
+                    character_id=character_id,
+                    copy_name=self.config["use_char_name"],
+                    copy_avatar=self.config["use_char_avatar"],
+                ),
             )
 
         await self._reply(event=event, body=ai_reply)
 
     @cai.subcommand(name="sync_info")
-    async def sync_info(self, event: MessageEvent) -> None:
+    @command.argument("force", required=False)
+    async def sync_info(self, event: MessageEvent, force: str) -> None:
         if not self.is_user_allowed(event.sender):
             return
 
         if not self.config["use_char_name"] and not self.config["use_char_avatar"]:
-            await self._reply(
-                event=event,
-                body="Both `use_char_name` and `use_char_avatar` are disabled, nothing to do.",
+            await self._reply_static(
+                event=event, body=NOTHING_TO_SYNC_MESSAGE, reply=self._reply_to_message
             )
             return
 
         # TODO: this is duplicated code, should be factored out
-        query = await self._get_chat_by_room(event.room_id)
+        query = self._get_chat_by_room(event.room_id)
         if query is None:
-            await event.respond(
-                "This room doesn't have an AI chat yet. Create one with `!cai new_chat`"
-            )
+            await self._reply_static(event=event, body=NO_CHAT_MESSAGE)
             return
         character_id, _ = query
 
@@ -410,48 +660,76 @@ class CAIBot(Plugin):
             character_id=character_id,
             copy_name=self.config["use_char_name"],
             copy_avatar=self.config["use_char_avatar"],
+            # `!cai sync_info --force` fetches the character's info again
+            use_cache=force != "--force",
         )
 
         await event.react("✅")
 
     @event.on(EventType.ROOM_MESSAGE)
     async def on_message(self, event: MessageEvent) -> None:
-        # Mark message as read, so the user can see the bot is alive
-        await event.mark_read()
-
-        if not await self.is_bot_triggered(event):
+        # Reject most messages right away, before doing any request
+        if self.is_message_ignored(event):
             return
 
+        # Send the read receipt while we check if the message triggers us
+        read_receipt = (
+            asyncio.create_task(event.mark_read()) if self._mark_read_all else None
+        )
+
         try:
-            # I really with you could use a context manager for this
-            async with client_typing(self.client, event):
-                query = await self._get_chat_by_room(event.room_id)
-                if query is None:
-                    await event.respond(
-                        "This room doesn't have an AI chat yet. Create one with `!cai new_chat`"
-                    )
-                    return
-                character_id, chat_id = query
+            # Check if the room is a DM at most once per message, and only
+            # if a setting depends on it (is_dm is unused otherwise)
+            is_dm = (
+                await self._is_room_dm(event.room_id)
+                if self._always_reply_in_dm
+                or self._group_mode is None
+                or self._show_prompt_in_reply is None
+                else False
+            )
 
-                text = str(event.content.body)
-                if self.config["strip_trigger_prefix"]:
-                    text = text.lstrip()
-                    if text.casefold().startswith(self.trigger):
-                        text = text[len(self.trigger) :]
-                text = await self._handle_group_mode(event, text)
+            is_triggered = await self.is_bot_triggered(event, is_dm=is_dm)
+        finally:
+            # Always wait for the receipt, so its errors aren't lost
+            if read_receipt is not None:
+                await read_receipt
+        if not is_triggered:
+            return
 
+        try:
+            query = self._get_chat_by_room(event.room_id)
+            if query is None:
+                await self._reply_static(event=event, body=NO_CHAT_MESSAGE)
+                return
+            character_id, chat_id = query
+
+            text = event.content.body
+            if self._strip_trigger_prefix:
+                text = text.lstrip()
+                # The compiled trigger only looks at the start of the message
+                if self._trigger_re is not None:
+                    if match := self._trigger_re.match(text):
+                        text = text[match.end() :]
+                elif self._trigger and text.casefold().startswith(self._trigger):
+                    text = text[len(self._trigger) :]
+            text = self._handle_group_mode(event, text, is_dm=is_dm)
+
+            # Only show the bot as typing while it's waiting for the AI
+            # Mark message as read (if it wasn't already), so the user can see the bot is alive
+            async with client_typing(
+                self.client, event, mark_read=read_receipt is None
+            ):
                 ai_reply = await self.send_message_to_ai(
                     text,
                     character_id=character_id,
                     chat_id=chat_id,
                 )
 
-                if (self.config["show_prompt_in_reply"] == True) or (
-                    self.config["show_prompt_in_reply"] is None
-                    and not await self._is_room_dm(event.room_id)
-                ):
-                    prompt = indent(text, "> ", predicate=lambda _: True)
-                    ai_reply = f"{prompt}\n\n{ai_reply}"
+            if (self._show_prompt_in_reply == True) or (
+                self._show_prompt_in_reply is None and not is_dm
+            ):
+                prompt = "> " + text.replace("\n", "\n> ")
+                ai_reply = f"{prompt}\n\n{ai_reply}"
 
             # Send the response back to the chat room
             await self._reply(event=event, body=ai_reply)
@@ -460,21 +738,64 @@ class CAIBot(Plugin):
             self.log.exception(f"Error while handing message: {e}")
             await event.respond(f"Error while handing message... {e}")
 
-    @property
-    def trigger(self) -> str:
-        """The casefolded trigger for the bot to respond to. Handles the {name} placeholder."""
-        t = self.config["trigger"]
+    @event.on(EventType.ROOM_MEMBER)
+    async def on_member(self, event: StateEvent) -> None:
+        # Rooms we haven't seen yet will be fetched on their first lookup
+        members = self._room_members.get(event.room_id)
+        if members is None:
+            return
 
-        # Ok so, for some reason, maubot calls EVERY properties at
-        # plugin registration time, which is before the config is loaded.
-        # So t will be None, and we need to handle that.
+        user_id = UserID(event.state_key)
+        if event.content.membership == Membership.JOIN:
+            members.add(user_id)
+        # We left the room, forget about it so it's fetched again if we come back
+        elif user_id == self.client.mxid:
+            del self._room_members[event.room_id]
+        else:
+            members.discard(user_id)
+
+    def _cache_config(self) -> None:
+        """Precomputes the values derived from the config, after it's (re)loaded."""
+        self._update_trigger()
+        self._allowed_users = frozenset(self.config["allowed_users"] or ())
+
+        # These are read for every message, so we avoid going through the config proxy
+        self._group_mode = self.config["group_mode"]
+        self._group_mode_template = self.config["group_mode_template"]
+        self._response_cache_enabled = self.config["response_cache_enabled"]
+        self._always_reply_in_dm = self.config["always_reply_in_dm"]
+        self._reply_is_trigger = self.config["reply_is_trigger"]
+        self._reply_to_message = self.config["reply_to_message"]
+        self._show_prompt_in_reply = self.config["show_prompt_in_reply"]
+        self._mark_read_all = self.config["mark_read_all"]
+        self._strip_trigger_prefix = self.config["strip_trigger_prefix"]
+
+    def _update_trigger(self) -> None:
+        """Caches the trigger, and a compiled pattern to search for it."""
+        t = self._resolve_trigger()
+        self._trigger = t.casefold()
+        # re.IGNORECASE only does simple case folding, so triggers that full
+        # casefolding changes (like "ß" to "ss") are searched in the casefolded text
+        self._trigger_re = (
+            re.compile(re.escape(t), re.IGNORECASE)
+            if t and self._trigger == t.lower()
+            else None
+        )
+
+    def _resolve_trigger(self) -> str:
+        """Computes the trigger from the config. Handles the {name} placeholder."""
+        t = self.config["trigger"]
         if t is None:
             return ""
 
         if t == "{name}":
             t = self.client.parse_user_id(self.client.mxid)[0]
 
-        return t.strip().casefold()
+        return t.strip()
+
+    def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        self._cache_config()
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
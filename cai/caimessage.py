@@ -1,18 +1,41 @@
+import gzip
 import json
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, field
 from datetime import datetime
-from io import BytesIO, StringIO
+from itertools import chain
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 from . import utils
 
 
-@dataclass
+@dataclass(slots=True)
 class CAIMessage:
     create_time: datetime
     author_name: str
     """The author's name on Character.AI"""
     author_is_human: bool
     content: str
+    _create_time_str: str | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _author_display: str = field(init=False, repr=False, compare=False)
+    """How the author is shown in the txt export"""
+
+    def __post_init__(self) -> None:
+        # Interned, so all the messages from a bot share the same string
+        self._author_display = (
+            "You" if self.author_is_human else sys.intern(f"{self.author_name} [bot]")
+        )
 
     @classmethod
     def from_dict(cls, data: dict):
@@ -31,70 +54,145 @@ class CAIMessage:
             content=content,
         )
 
+    def iso_time(self) -> str:
+        """The pretty create_time string, only formatted once per message."""
+        if self._create_time_str is None:
+            self._create_time_str = utils.pretty_utc_str(self.create_time)
+        return self._create_time_str
+
     def export_to_dict(self) -> dict:
         return {
-            "create_time": utils.pretty_utc_str(self.create_time),
+            "create_time": self.iso_time(),
             "author_name": self.author_name,
             "author_is_human": self.author_is_human,
             "content": self.content,
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class ExportFile:
     file_extension: str
     mimetype: str
     data: bytes
 
+    def gzipped(self) -> "ExportFile":
+        """Returns a gzip-compressed copy of the file."""
+        return ExportFile(
+            file_extension=f"{self.file_extension}.gz",
+            mimetype="application/gzip",
+            # Level 1 is cheap and plenty for text, mtime=0 keeps the output deterministic
+            data=gzip.compress(self.data, compresslevel=1, mtime=0),
+        )
+
 
-def history_to_txt(
+def _history_to_dict(
     history: list[CAIMessage], *, character_name: str, character_id: str, chat_id: str
+) -> dict:
+    """Converts a list of CAIMessages to a dict, for the structured exports."""
+    data = {}
+    data["character_name"] = character_name
+    data["character_id"] = character_id
+    data["chat_id"] = chat_id
+    data["start_time"] = history[0].iso_time()
+    data["end_time"] = history[-1].iso_time()
+    data["messages"] = [msg.export_to_dict() for msg in history]
+    return data
+
+
+def history_to_txt(
+    history: list[CAIMessage],
+    *,
+    character_name: str,
+    character_id: str,
+    chat_id: str,
+    compress: bool = False,
 ) -> ExportFile:
     """
     Converts a list of CAIMessages to a txt file-like object.
     The messages should already be in chronological order.
+    If compress is True, the file is gzipped.
     """
-    f = StringIO()
-
-    start_time_str = utils.pretty_utc_str(history[0].create_time)
-    end_time_str = utils.pretty_utc_str(history[-1].create_time)
+    start_time_str = history[0].iso_time()
+    end_time_str = history[-1].iso_time()
 
     # Write the header
-    f.write(f"Character: {character_name} ({character_id})\n")
-    f.write(f"Chat ID: {chat_id}\n")
-    f.write(f"Messages: {len(history)}\n")
-    f.write(f"{start_time_str} - {end_time_str}\n")
-    f.write(f"{'='*60}\n\n")
+    header = (
+        f"Character: {character_name} ({character_id})\n"
+        f"Chat ID: {chat_id}\n"
+        f"Messages: {len(history)}\n"
+        f"{start_time_str} - {end_time_str}\n"
+        f"{'='*60}\n\n"
+    )
 
     # Write the messages
-    for msg in history:
-        author = "You" if msg.author_is_human else f"{msg.author_name} [bot]"
-        f.write(f"{author} - {utils.pretty_utc_str(msg.create_time)}\n")
-        f.write(f"{msg.content}\n\n")
-    f.seek(0)
+    messages = (
+        f"{msg._author_display} - {msg.iso_time()}\n{msg.content}\n\n"
+        for msg in history
+    )
 
-    return ExportFile(
-        file_extension="txt", mimetype="text/plain", data=f.read().encode()
+    # Join everything at once, so the text is only copied by the final encode
+    file = ExportFile(
+        file_extension="txt",
+        mimetype="text/plain",
+        data="".join(chain((header,), messages)).encode("utf-8"),
     )
+    return file.gzipped() if compress else file
 
 
 def history_to_json(
-    history: list[CAIMessage], *, character_name: str, character_id: str, chat_id: str
+    history: list[CAIMessage],
+    *,
+    character_name: str,
+    character_id: str,
+    chat_id: str,
+    compress: bool = False,
 ) -> ExportFile:
     """
-    Converts a list of CAIMessages to a json file-like object.
+    Converts a list of CAIMessages to a compact json file-like object.
+    The output is the same whether orjson is installed or not.
+    If compress is True, the file is gzipped.
     """
+    data = _history_to_dict(
+        history,
+        character_name=character_name,
+        character_id=character_id,
+        chat_id=chat_id,
+    )
 
-    data = {}
-    data["character_name"] = character_name
-    data["character_id"] = character_id
-    data["chat_id"] = chat_id
-    data["start_time"] = utils.pretty_utc_str(history[0].create_time)
-    data["end_time"] = utils.pretty_utc_str(history[-1].create_time)
-    data["messages"] = [msg.export_to_dict() for msg in history]
+    # orjson is much faster, and gives bytes directly, but it's optional
+    if orjson is not None:
+        json_data = orjson.dumps(data)
+    else:
+        # Compact, so the stdlib uses its C encoder, and written exactly like orjson:
+        # same separators, and non-ASCII text kept as raw UTF-8 instead of \uXXXX
+        json_str = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+        json_data = json_str.encode("utf-8")
+
+    file = ExportFile(
+        file_extension="json", mimetype="application/json", data=json_data
+    )
+    return file.gzipped() if compress else file
 
-    json_data = json.dumps(data, indent=4)
+
+def history_to_cbor(
+    history: list[CAIMessage], *, character_name: str, character_id: str, chat_id: str
+) -> ExportFile:
+    """
+    Converts a list of CAIMessages to a CBOR file-like object.
+    Same structure as the json export, but smaller. Requires cbor2.
+    """
+    if cbor2 is None:
+        raise ImportError("cbor2 is required for the CBOR export")
+
+    data = _history_to_dict(
+        history,
+        character_name=character_name,
+        character_id=character_id,
+        chat_id=chat_id,
+    )
+    # String references deduplicate the author names and repeated keys
+    cbor_data = cbor2.dumps(data, string_referencing=True)
 
     return ExportFile(
-        file_extension="json", mimetype="application/json", data=json_data.encode()
+        file_extension="cbor", mimetype="application/cbor", data=cbor_data
     )
@@ -1,4 +1,12 @@
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_ZERO = timedelta(0)
 
 
 def pretty_utc_str(dt: datetime, /) -> str:
@@ -6,6 +14,46 @@ def pretty_utc_str(dt: datetime, /) -> str:
     Converts a datetime with UTC timezone to a string,
     with some prettifying but still ISO-compliant.
     """
+    # Fast path for UTC datetimes, which is what character.ai gives us
+    if dt.tzinfo is not None and dt.utcoffset() == _ZERO:
+        return (
+            f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+            f"T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}Z"
+        )
+
     # We remove the milliseconds, because they make output too noisy
     # We replace the timezone with Z, to be more concise in showing it's UTC
     return dt.replace(microsecond=0).isoformat().replace("+00:00", "Z")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    A LRU cache where entries also expire after `ttl` seconds.
+    Not thread-safe, but that's fine since we only use it from the event loop.
+    """
+
+    def __init__(self, *, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[V, float]] = OrderedDict()
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        """Returns the cached value, or default if it's missing or expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+
+        value, expires_at = entry
+        if expires_at <= monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        """Caches a value, evicting the least recently used entries if needed."""
+        self._data[key] = (value, monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)